@@ -1,8 +1,11 @@
 # src/cat_embedding/__main__.py
-import argparse, json, os
+import argparse, json, os, sys
 from pathlib import Path
 from .schema import CatMeta
-from .gallery import build_gallery, load_gallery, build_vector, match_query
+from .gallery import (build_gallery, load_gallery, load_metadata, build_vector, build_vectors,
+                      match_ranked, stack_gallery, match_multishot, MULTISHOT_MODES,
+                      read_gallery_header, check_gallery_header, DEFAULT_WEIGHTS)
+from .evaluate import load_labelled, evaluate, DEFAULT_THRESHOLDS, DEFAULT_MARGINS
 
 def main():
     ap = argparse.ArgumentParser("cat-embedding (Re-ID)")
@@ -12,13 +15,54 @@ def main():
     b.add_argument("--meta", required=True, help="metadata.json or .jsonl")
     b.add_argument("--out",  required=True, help="output npz path")
     b.add_argument("--bounds", default=None, help="lat/lon bounds json: [min_lat,max_lat,min_lon,max_lon]")
+    b.add_argument("--weights", type=weights_arg, default=DEFAULT_WEIGHTS, help="fusion weights json: [w_img,w_geo,w_human] (기본 [0.85,0.05,0.10])")
 
     m = sub.add_parser("match", help="쿼리 메타데이터 1건(or 여러건) 매칭")
     m.add_argument("--gallery", required=True)
     m.add_argument("--query",   required=True, help="query metadata json (one or list)")
-    m.add_argument("--bounds",  default=None)
+    m.add_argument("--bounds",  default=None, help="헤더 없는 구버전 갤러리용 (헤더가 있으면 저장된 bounds 사용)")
     m.add_argument("--thr",     type=float, default=0.80)
-    m.add_argument("--margin",  type=float, default=0.05)
+    m.add_argument("--margin",  type=float, default=0.05, help="1위 개체 내 2순위 사진과의 차이 마진 (--shots mean)")
+    m.add_argument("--topk",    type=positive_int, default=None, help="상위 K개 후보(cat_id별 유사도) 함께 출력")
+    m.add_argument("--batch",   action="store_true", help="쿼리 각각을 독립 매칭(단일 샷, --shots mean만 가능), 결과를 JSON Lines로 스트리밍 출력")
+    m.add_argument("--shots",   default="mean", choices=("mean",) + MULTISHOT_MODES,
+                   help="멀티샷 집계: mean(평균 벡터) | max | top_p(상위 p 비율 샷 평균) | set(set-to-set)")
+    m.add_argument("--top-p",   type=float, default=0.5, help="--shots top_p에서 사용할 상위 샷 비율")
+    m.add_argument("--id-margin", type=float, default=0.05,
+                   help="--shots max/top_p/set 판정 마진: 1위와 2위 개체 점수 차이 (--margin은 mean에서만 사용)")
+
+    e = sub.add_parser("eval", help="라벨링된 JSONL로 정확도/속도 오프라인 평가")
+    e.add_argument("--data",    required=True, help="labelled .jsonl (cat_id 필수, 선택 split: gallery/query)")
+    e.add_argument("--bounds",  default=None)
+    e.add_argument("--weights", type=weights_arg, default=DEFAULT_WEIGHTS, help="fusion weights json: [w_img,w_geo,w_human]")
+    e.add_argument("--thr",     type=float, nargs="+", default=list(DEFAULT_THRESHOLDS), help="sweep할 임계값들")
+    e.add_argument("--margin",  type=float, nargs="+", default=list(DEFAULT_MARGINS), help="sweep할 마진들")
+    e.add_argument("--per-id",  type=int, default=1, help="split 필드가 없을 때 cat_id별 갤러리 사진 수")
+    e.add_argument("--holdout", type=float, default=0.2, help="갤러리에서 뺄 identity 비율(open-set 음성 쿼리)")
+    e.add_argument("--seed",    type=int, default=0)
+    e.add_argument("--batch-size", type=int, default=32, help="임베딩 배치 크기")
+    e.add_argument("--dtype",   default="float64", choices=("float64", "float32", "float16"),
+                   help="유사도 계산 정밀도(양자화 영향 측정용)")
+    e.add_argument("--out",     default=None, help="결과 JSON 저장 경로")
+
+    w = sub.add_parser("watch", help="폴더를 감시하며 새 이미지를 자동 매칭/등록")
+    w.add_argument("dir", help="감시할 폴더 (이미지 + 선택적 같은 이름의 .json 사이드카)")
+    w.add_argument("--gallery", required=True, help="갤러리 npz (없으면 새로 생성)")
+    w.add_argument("--meta",    default="ingested.jsonl", help="새로 등록된 사진의 메타데이터를 append할 .jsonl")
+    w.add_argument("--bounds",  default=None, help="헤더 없는/새 갤러리용 (헤더가 있으면 저장된 bounds 사용)")
+    w.add_argument("--thr",     type=float, default=0.80)
+    w.add_argument("--margin",  type=float, default=0.05)
+    w.add_argument("--window",  type=float, default=2.0, help="배치로 모을 최대 대기 시간(초)")
+    w.add_argument("--batch-size", type=int, default=32, help="한 번에 임베딩할 최대 사진 수")
+    w.add_argument("--max-pending", type=int, default=256, help="대기열 최대 길이 (초과분은 디스크에 남겨둠)")
+    w.add_argument("--poll",    type=float, default=1.0, help="폴링 주기(초), watchdog 사용 시 재확인 주기")
+    w.add_argument("--settle",  type=float, default=1.0, help="이 시간(초) 동안 변경 없는 파일만 처리")
+    w.add_argument("--sidecar-wait", type=float, default=2.0,
+                   help="사이드카(.json) 없는 이미지는 이 시간(초)만큼 더 기다린 뒤 처리")
+    w.add_argument("--append-matches", action="store_true", help="기존 개체로 매칭된 사진도 갤러리에 추가")
+    w.add_argument("--flush-interval", type=float, default=30.0,
+                   help="갤러리 npz를 다시 쓰는 최소 간격(초). 메타데이터 JSONL은 배치마다 바로 append")
+    w.add_argument("--once",    action="store_true", help="현재 폴더 내용만 처리하고 종료")
 
     c = sub.add_parser("clean", help="임베딩 정보 및 갤러리 파일 삭제")
     c.add_argument("--gallery", help="삭제할 갤러리 파일 (.npz)")
@@ -29,6 +73,9 @@ def main():
     i.add_argument("--with-images", action="store_true", help="이미지 파일이 있는 경우 자동으로 메타데이터 생성")
 
     args = ap.parse_args()
+    if args.cmd == "match" and args.batch and args.shots != "mean":
+        # 배치는 쿼리 한 건 = 사진 한 장이라 멀티샷 집계(--shots/--top-p/--id-margin)가 적용되지 않음
+        m.error("--batch는 쿼리를 한 장씩 매칭하므로 --shots max/top_p/set과 함께 쓸 수 없습니다")
 
     if args.cmd == "build":
         bounds = json.loads(args.bounds) if args.bounds else None
@@ -55,7 +102,7 @@ def main():
             print("EOF")
             return
         
-        build_gallery(args.meta, args.out, bounds=bounds)
+        build_gallery(args.meta, args.out, bounds=bounds, weights=args.weights)
         print(f"✅ gallery saved to {args.out}")
 
     elif args.cmd == "match":
@@ -88,17 +135,32 @@ def main():
             print("EOF")
             return
         
+        # 헤더만 읽어 호환성 확인 후 저장된 bounds/weights 재사용
+        try:
+            bounds, weights = resolve_gallery_settings(args.gallery, bounds)
+        except ValueError as e:
+            print(f"❌ 갤러리를 사용할 수 없습니다: {e}")
+            print("💡 현재 설정으로 갤러리를 다시 구축하세요:")
+            print(f"   cat-embedding build --meta metadata.json --out {args.gallery}")
+            return
+
         gal = load_gallery(args.gallery)
-        payload = json.loads(open(args.query, "r", encoding="utf-8").read())
-        metas = [CatMeta(**payload)] if isinstance(payload, dict) else [CatMeta(**x) for x in payload]
-        # multi-shot: 쿼리 여러 장이면 평균 벡터로
-        vecs = [build_vector(m, bounds=bounds) for m in metas]
-        import numpy as np
-        q = np.mean(vecs, axis=0)  # 간단 평균 (필요 시 상위 p% 평균 등으로 개선)
-        pred, sim = match_query(q, gal, threshold=args.thr, margin=args.margin)
+        metas = load_query_metas(args.query)
+        stacked = stack_gallery(gal)  # 쿼리마다 재사용
+
+        if args.batch:
+            # 배치: 쿼리마다 독립 매칭, 결과를 한 줄씩 바로 출력(JSON Lines)
+            for meta in metas:
+                q = build_vector(meta, bounds=bounds, weights=weights)
+                _, _, result = match_with_ranking(q, gal, args, stacked)
+                print(json.dumps({"image_path": meta.image_path, **result}, ensure_ascii=False), flush=True)
+            return
+
+        # multi-shot: 샷 벡터는 한 번의 배치로 생성 후 --shots 방식으로 집계
+        vecs = build_vectors(metas, bounds=bounds, weights=weights)
+        pred, sim, result = match_shots(vecs, gal, args, stacked)
         
         # 결과 출력
-        result = {"pred": pred, "sim": round(float(sim),4)}
         print(json.dumps(result, ensure_ascii=False))
         
         # 새로운 개체로 확인된 경우 metadata 추가 제안
@@ -148,7 +210,7 @@ def main():
                         
                         # 갤러리 재구축
                         print("🔄 갤러리 재구축 중...")
-                        build_gallery(metadata_file, args.gallery, bounds=bounds)
+                        build_gallery(metadata_file, args.gallery, bounds=bounds, weights=weights)
                         print(f"✅ 갤러리 재구축 완료: {args.gallery}")
                         print(f"💡 이제 {new_id}로 매칭할 수 있습니다!")
                     else:
@@ -160,12 +222,123 @@ def main():
                 print(f"❌ 메타데이터 파일을 찾을 수 없습니다: {metadata_file}")
                 print("💡 먼저 메타데이터 파일을 생성하세요")
 
+    elif args.cmd == "eval":
+        if not os.path.exists(args.data):
+            print(f"❌ 평가 데이터 파일을 찾을 수 없습니다: {args.data}")
+            print("💡 metadata와 같은 형식의 JSONL에 cat_id(필수)와 split(선택: gallery/query)을 넣으세요")
+            return
+        bounds = json.loads(args.bounds) if args.bounds else None
+        try:
+            report = evaluate(load_labelled(args.data), bounds=bounds, weights=args.weights,
+                              thresholds=args.thr, margins=args.margin, per_id=args.per_id,
+                              holdout=args.holdout, seed=args.seed,
+                              batch_size=args.batch_size, dtype=args.dtype)
+        except ValueError as e:
+            print(f"❌ 평가 실패: {e}")
+            return
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        print(text)
+        if args.out:
+            Path(args.out).write_text(text, encoding="utf-8")
+            print(f"✅ eval report saved to {args.out}")
+
+    elif args.cmd == "watch":
+        if not os.path.isdir(args.dir):
+            print(f"❌ 감시할 폴더를 찾을 수 없습니다: {args.dir}")
+            return
+        if Path(args.meta).suffix != ".jsonl":
+            print(f"❌ --meta는 .jsonl이어야 합니다 (append 전용): {args.meta}")
+            return
+        bounds = json.loads(args.bounds) if args.bounds else None
+        if os.path.exists(args.gallery):
+            try:
+                bounds, _ = resolve_gallery_settings(args.gallery, bounds)
+            except ValueError as e:
+                print(f"❌ 갤러리를 사용할 수 없습니다: {e}")
+                return
+        from .watch import watch_folder, WATCHDOG_AVAILABLE
+        if not args.once:
+            mode = "watchdog 이벤트" if WATCHDOG_AVAILABLE else f"{args.poll}초 폴링"
+            print(f"👀 {args.dir} 감시 시작 ({mode}, Ctrl+C로 종료)", file=sys.stderr)
+        try:
+            watch_folder(args.dir, args.gallery, once=args.once, meta_path=args.meta, bounds=bounds,
+                         threshold=args.thr, margin=args.margin, window=args.window,
+                         batch_size=args.batch_size, max_pending=args.max_pending,
+                         poll=args.poll, settle=args.settle, append_matches=args.append_matches,
+                         flush_interval=args.flush_interval, sidecar_wait=args.sidecar_wait)
+        except KeyboardInterrupt:
+            print("⏹️  감시 종료", file=sys.stderr)
+        except ValueError as e:
+            print(f"❌ 갤러리를 사용할 수 없습니다: {e}")
+
     elif args.cmd == "clean":
         clean_embedding_files(args)
 
     elif args.cmd == "init":
         init_project(args)
 
+def resolve_gallery_settings(gallery_path: str, bounds=None):
+    """갤러리 헤더 검증 후 쿼리에 사용할 (bounds, weights) 반환. 호환 불가면 ValueError"""
+    header = read_gallery_header(gallery_path)
+    if header is None:
+        print("⚠️  헤더 없는 구버전 갤러리 - 임베더/bounds 일치 여부를 확인할 수 없습니다", file=sys.stderr)
+        return bounds, DEFAULT_WEIGHTS
+    check_gallery_header(header)
+    stored = header.get("bounds")
+    if bounds is not None and [float(b) for b in bounds] != stored:
+        print(f"⚠️  --bounds {list(bounds)} 대신 갤러리에 저장된 bounds {stored}를 사용합니다", file=sys.stderr)
+    return stored, tuple(header["weights"])
+
+def load_query_metas(path: str):
+    """쿼리 파일(.json 단건/배열 또는 .jsonl) → CatMeta 리스트"""
+    if Path(path).suffix == ".jsonl":
+        return load_metadata(path)
+    payload = json.loads(open(path, "r", encoding="utf-8").read())
+    return [CatMeta(**payload)] if isinstance(payload, dict) else [CatMeta(**x) for x in payload]
+
+def weights_arg(value: str):
+    """argparse type: fusion weights json → (w_img, w_geo, w_human) 3개 float"""
+    try:
+        weights = json.loads(value)
+    except json.JSONDecodeError:
+        raise argparse.ArgumentTypeError(f"JSON 배열이어야 합니다: {value}")
+    if (not isinstance(weights, list) or len(weights) != 3
+            or not all(isinstance(w, (int, float)) and not isinstance(w, bool) for w in weights)):
+        raise argparse.ArgumentTypeError(f"[w_img,w_geo,w_human] 숫자 3개여야 합니다: {value}")
+    return tuple(float(w) for w in weights)
+
+def positive_int(value: str) -> int:
+    """argparse type: 1 이상의 정수"""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"1 이상의 정수여야 합니다: {value}")
+    return n
+
+def match_result(pred, sim, ranking, args):
+    """pred/sim과 (--topk 지정 시) 순위를 반올림해 출력용 dict 생성. UNKNOWN이어도 순위는 그대로 보고"""
+    result = {"pred": pred, "sim": round(float(sim),4)}
+    if args.topk:
+        result["topk"] = [{"cat_id": r["cat_id"], "sim": round(r["sim"],4),
+                           "second": round(r["second"],4), "index": r["index"]}
+                          for r in ranking]
+    return result
+
+def match_with_ranking(q, gal, args, stacked=None):
+    """open-set 판정(pred)과 --topk 순위를 한 번의 점수 계산으로 담은 결과 dict 생성"""
+    pred, sim, ranking = match_ranked(q, gal, threshold=args.thr, margin=args.margin,
+                                      k=args.topk or 0, stacked=stacked)
+    return pred, sim, match_result(pred, sim, ranking, args)
+
+def match_shots(vecs, gal, args, stacked=None):
+    """멀티샷 쿼리 (S, D) 매칭. mean은 평균 벡터 1개로, 그 외는 샷별 점수를 identity별 집계"""
+    if args.shots == "mean":
+        import numpy as np
+        return match_with_ranking(np.mean(vecs, axis=0), gal, args, stacked)
+    pred, sim, ranking = match_multishot(vecs, gal, mode=args.shots, p=args.top_p,
+                                         threshold=args.thr, id_margin=args.id_margin,
+                                         k=args.topk or 0, stacked=stacked)
+    return pred, sim, match_result(pred, sim, ranking, args)
+
 def clean_embedding_files(args):
     """임베딩 관련 파일들을 삭제하는 함수"""
     deleted_files = []
@@ -9,9 +9,13 @@ try:
     _device = "cuda" if torch.cuda.is_available() else "cpu"
     _model, _preprocess = clip.load("ViT-B/32", device=_device)
     CLIP_AVAILABLE = True
+    EMBEDDER = "clip:ViT-B/32"
+    EMBED_DIM = int(_model.visual.output_dim)
     print("✅ CLIP 모델 로드됨")
 except ImportError:
     CLIP_AVAILABLE = False
+    EMBEDDER = "pixel:64x64"
+    EMBED_DIM = 64 * 64 * 3
     print("⚠️  PyTorch/CLIP 미설치 - 간단한 픽셀 임베딩 사용")
 
 def _simple_image_embedding(path: str) -> np.ndarray:
@@ -41,3 +45,15 @@ def image_embedding(path: str) -> np.ndarray:
         return emb[0]
     else:
         return _simple_image_embedding(path)
+
+def image_embeddings(paths) -> np.ndarray:
+    """여러 이미지를 (S, D) 임베딩 행렬로. CLIP은 한 번의 배치 forward로 처리"""
+    paths = list(paths)
+    if not paths:
+        return np.zeros((0, 0))
+    if CLIP_AVAILABLE:
+        imgs = torch.stack([_preprocess(Image.open(p).convert("RGB")) for p in paths]).to(_device)
+        with torch.no_grad():
+            return _model.encode_image(imgs).cpu().numpy()  # (S, 512) 또는 (S, 768)
+    else:
+        return np.vstack([_simple_image_embedding(p) for p in paths])
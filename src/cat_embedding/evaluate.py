@@ -0,0 +1,127 @@
+# src/cat_embedding/evaluate.py
+import json, time, numpy as np
+from pathlib import Path
+from typing import List, Dict, Tuple, Optional, Sequence
+
+from .schema import CatMeta
+from .fuse import l2_normalize
+from .gallery import (build_vectors, stack_gallery, per_identity_top2, open_set_decision,
+                      DEFAULT_WEIGHTS)
+
+DEFAULT_THRESHOLDS = tuple(round(0.50 + 0.05 * i, 2) for i in range(10))  # 0.50 ~ 0.95
+DEFAULT_MARGINS = (0.0, 0.02, 0.05, 0.10)
+
+def load_labelled(path: str) -> List[Tuple[CatMeta, Optional[str]]]:
+    """라벨링된 JSONL → [(CatMeta, split)]. split은 각 줄의 "split" 필드("gallery"/"query", 선택)"""
+    rows = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        raw = json.loads(line)
+        if raw.get("cat_id") is None:
+            raise ValueError(f"labelled row without cat_id: {line}")
+        rows.append((CatMeta(**raw), raw.get("split")))
+    return rows
+
+def split_rows(rows: List[Tuple[CatMeta, Optional[str]]], per_id: int = 1,
+               holdout: float = 0.2, seed: int = 0) -> Tuple[List[CatMeta], List[CatMeta]]:
+    """(gallery, query) 분할.
+
+    "split" 필드가 있으면 그대로 따른다. 없으면 cat_id별 앞의 per_id장을 갤러리로,
+    나머지를 쿼리로 쓰고, identity의 holdout 비율은 갤러리에서 통째로 빼서
+    open-set 음성(UNKNOWN이어야 하는) 쿼리로 만든다.
+    """
+    if any(split is not None for _, split in rows):
+        gal = [m for m, split in rows if split == "gallery"]
+        qry = [m for m, split in rows if split != "gallery"]
+        return gal, qry
+    ids = sorted({m.cat_id for m, _ in rows})
+    rng = np.random.default_rng(seed)
+    n_out = int(round(holdout * len(ids)))
+    held = set(rng.permutation(ids)[:n_out].tolist()) if n_out else set()
+    gal, qry, seen = [], [], {}
+    for m, _ in rows:
+        if m.cat_id not in held and seen.get(m.cat_id, 0) < per_id:
+            seen[m.cat_id] = seen.get(m.cat_id, 0) + 1
+            gal.append(m)
+        else:
+            qry.append(m)
+    return gal, qry
+
+def embed_batched(metas: List[CatMeta], bounds=None, weights=DEFAULT_WEIGHTS,
+                  batch_size: int = 32) -> np.ndarray:
+    """메모리 한도를 위해 batch_size 단위로 build_vectors 호출"""
+    chunks = [build_vectors(metas[i:i + batch_size], bounds=bounds, weights=weights)
+              for i in range(0, len(metas), batch_size)]
+    return np.vstack(chunks)
+
+def sweep_open_set(correct: np.ndarray, known: np.ndarray, best_sim: np.ndarray,
+                   best_second: np.ndarray, thresholds: Sequence[float],
+                   margins: Sequence[float]) -> List[Dict]:
+    """모든 (thr, margin) 조합의 TPR/FPR을 (T, M, Q) 브로드캐스트 한 번으로 계산.
+
+    TPR: 갤러리에 있는 쿼리 중 올바른 cat_id로 수락된 비율
+    FPR: 갤러리에 없는 쿼리 중 (UNKNOWN이 아닌) 어떤 cat_id로 수락된 비율
+    """
+    thr = np.asarray(thresholds, dtype=float)[:, None, None]
+    mar = np.asarray(margins, dtype=float)[None, :, None]
+    accept = (best_sim[None, None, :] >= thr) & ((best_sim - best_second)[None, None, :] >= mar)
+    n_known, n_unknown = int(known.sum()), int((~known).sum())
+    tp = (accept & (correct & known)[None, None, :]).sum(axis=2)
+    fp = (accept & (~known)[None, None, :]).sum(axis=2)
+    tpr = tp / n_known if n_known else np.full(tp.shape, np.nan)
+    fpr = fp / n_unknown if n_unknown else np.full(fp.shape, np.nan)
+    return [{"thr": float(t), "margin": float(m),
+             "tpr": _num(tpr[i, j]), "fpr": _num(fpr[i, j])}
+            for i, t in enumerate(thresholds) for j, m in enumerate(margins)]
+
+def _num(x) -> Optional[float]:
+    return None if np.isnan(x) else round(float(x), 4)
+
+def evaluate(rows: List[Tuple[CatMeta, Optional[str]]], bounds=None, weights=DEFAULT_WEIGHTS,
+             thresholds: Sequence[float] = DEFAULT_THRESHOLDS,
+             margins: Sequence[float] = DEFAULT_MARGINS, per_id: int = 1,
+             holdout: float = 0.2, seed: int = 0, batch_size: int = 32,
+             dtype: str = "float64") -> Dict:
+    """갤러리/쿼리 분할 → 배치 임베딩 → 유사도 행렬 1회 계산 → rank-1, open-set sweep, QPS"""
+    gal_metas, qry_metas = split_rows(rows, per_id=per_id, holdout=holdout, seed=seed)
+    if not gal_metas or not qry_metas:
+        raise ValueError(f"need both gallery and query rows (gallery={len(gal_metas)}, query={len(qry_metas)})")
+
+    t0 = time.perf_counter()
+    gal_vecs = embed_batched(gal_metas, bounds=bounds, weights=weights, batch_size=batch_size)
+    t1 = time.perf_counter()
+    qry_vecs = embed_batched(qry_metas, bounds=bounds, weights=weights, batch_size=batch_size)
+    t2 = time.perf_counter()
+
+    gallery: Dict[str, List[np.ndarray]] = {}
+    for m, v in zip(gal_metas, gal_vecs):
+        gallery.setdefault(m.cat_id, []).append(l2_normalize(v))
+    ids, mat, offsets = stack_gallery({k: np.vstack(v) for k, v in gallery.items()})
+    mat = mat.astype(dtype)
+    q = np.vstack([l2_normalize(v) for v in qry_vecs]).astype(dtype)
+
+    t3 = time.perf_counter()
+    sims = (q @ mat.T).astype(np.float64)  # (Q, N) — 이후 모든 설정은 이 행렬 재사용
+    s1, s2, _ = per_identity_top2(sims, offsets)
+    pred, best_sim, best_second = open_set_decision(s1, s2)
+    t4 = time.perf_counter()
+
+    index = {k: i for i, k in enumerate(ids)}
+    labels = np.array([index.get(m.cat_id, -1) for m in qry_metas])
+    known = labels >= 0
+    correct = pred == labels
+    n_q = len(qry_metas)
+    sweep = sweep_open_set(correct, known, best_sim, best_second, thresholds, margins)
+    return {
+        "n_gallery": len(gal_metas), "n_ids": len(ids),
+        "n_query": n_q, "n_known": int(known.sum()), "n_unknown": int((~known).sum()),
+        "dtype": dtype,
+        "rank1": _num(correct[known].mean()) if known.any() else None,
+        "qps": {"match": round(n_q / max(t4 - t3, 1e-9), 1),
+                "embed": round(n_q / max(t2 - t1, 1e-9), 1),
+                "end_to_end": round(n_q / max((t2 - t1) + (t4 - t3), 1e-9), 1)},
+        "seconds": {"gallery_embed": round(t1 - t0, 4), "query_embed": round(t2 - t1, 4),
+                    "match": round(t4 - t3, 4)},
+        "sweep": sweep,
+    }
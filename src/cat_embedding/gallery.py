@@ -1,15 +1,20 @@
 # src/cat_embedding/gallery.py
-import json, numpy as np
+import json, hashlib, numpy as np
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 from sklearn.metrics.pairwise import cosine_similarity
 
 from .schema import CatMeta
 from .features import human_feature_vector
 from .geo import normalize_latlon, extract_gps_from_image
-from .embedding_extractor import image_embedding
+from .embedding_extractor import image_embedding, image_embeddings, EMBEDDER, EMBED_DIM
 from .fuse import fuse_vectors
 
+GALLERY_FORMAT = "cat-embedding-gallery"
+GALLERY_VERSION = 1
+HEADER_KEY = "__header__"  # npz 안의 헤더 항목 이름(cat_id로 사용 불가)
+DEFAULT_WEIGHTS = (0.85, 0.05, 0.10)
+
 def load_metadata(path: str) -> List[CatMeta]:
     metas = []
     p = Path(path)
@@ -22,8 +27,17 @@ def load_metadata(path: str) -> List[CatMeta]:
             metas.append(CatMeta(**row))
     return metas
 
-def build_vector(meta: CatMeta, bounds=None, weights=(0.85, 0.05, 0.10)) -> np.ndarray:
+def build_vector(meta: CatMeta, bounds=None, weights=DEFAULT_WEIGHTS) -> np.ndarray:
     img = image_embedding(meta.image_path)
+    return _fuse_meta(meta, img, bounds=bounds, weights=weights)
+
+def build_vectors(metas: List[CatMeta], bounds=None, weights=DEFAULT_WEIGHTS) -> np.ndarray:
+    """여러 메타데이터(멀티샷) → (S, D) 벡터 행렬. 이미지 임베딩은 한 번의 배치로 계산"""
+    imgs = image_embeddings([m.image_path for m in metas])
+    return np.vstack([_fuse_meta(m, img, bounds=bounds, weights=weights)
+                      for m, img in zip(metas, imgs)])
+
+def _fuse_meta(meta: CatMeta, img: np.ndarray, bounds=None, weights=DEFAULT_WEIGHTS) -> np.ndarray:
     # If lat/lon missing, try EXIF GPS extraction from the image
     lat, lon = meta.lat, meta.lon
     if lat is None or lon is None:
@@ -34,20 +48,102 @@ def build_vector(meta: CatMeta, bounds=None, weights=(0.85, 0.05, 0.10)) -> np.n
     human = human_feature_vector(meta)
     return fuse_vectors(img, geo, human, *weights)
 
-def build_gallery(metadata_path: str, out_path: str, bounds=None) -> Dict[str, List[np.ndarray]]:
+def build_gallery(metadata_path: str, out_path: str, bounds=None,
+                  weights=DEFAULT_WEIGHTS) -> Dict[str, List[np.ndarray]]:
     metas = load_metadata(metadata_path)
     gallery: Dict[str, List[np.ndarray]] = {}
+    hashes: Dict[str, List[Optional[str]]] = {}
     for m in metas:
-        vec = build_vector(m, bounds=bounds)
+        vec = build_vector(m, bounds=bounds, weights=weights)
         key = m.cat_id or "__unknown__"
         gallery.setdefault(key, []).append(vec)
-    # 저장(간단히 npz)
-    np.savez_compressed(out_path, **{k: np.vstack(v) for k, v in gallery.items()})
+        hashes.setdefault(key, []).append(file_sha256(m.image_path))
+    data = {k: np.vstack(v) for k, v in gallery.items()}
+    header = make_gallery_header(data, bounds=bounds, weights=weights,
+                                 image_hashes=[h for k in data for h in hashes[k]],
+                                 human_dim=human_feature_vector(metas[0]).size if metas else 0)
+    save_gallery(out_path, data, header)
     return gallery
 
-def load_gallery(npz_path: str) -> Dict[str, np.ndarray]:
+def save_gallery(out_path: str, data: Dict[str, np.ndarray], header: Dict) -> None:
+    """갤러리 행렬들과 헤더(JSON 문자열)를 npz 하나로 저장"""
+    if HEADER_KEY in data:
+        raise ValueError(f"'{HEADER_KEY}' cannot be used as a cat_id")
+    np.savez_compressed(out_path, **{HEADER_KEY: np.array(json.dumps(header, ensure_ascii=False))},
+                        **data)
+
+def load_gallery(npz_path: str, verify: bool = False) -> Dict[str, np.ndarray]:
+    """갤러리 로드. verify=True면 헤더 checksum과 데이터 일치 여부 확인(불일치 시 ValueError)"""
     d = np.load(npz_path, allow_pickle=False)
-    return {k: d[k] for k in d.files}
+    gallery = {k: d[k] for k in d.files if k != HEADER_KEY}
+    if verify and HEADER_KEY in d.files:
+        header = json.loads(str(d[HEADER_KEY]))
+        if gallery_checksum(gallery, header["ids"]) != header["checksum"]:
+            raise ValueError(f"gallery checksum mismatch: {npz_path}")
+    return gallery
+
+def read_gallery_header(npz_path: str) -> Optional[Dict]:
+    """헤더만 읽는다(npz는 항목별 지연 로드라 벡터 데이터는 풀지 않음). 구버전 갤러리는 None"""
+    with np.load(npz_path, allow_pickle=False) as d:
+        if HEADER_KEY not in d.files:
+            return None
+        return json.loads(str(d[HEADER_KEY]))
+
+def current_dims() -> Dict[str, int]:
+    """현재 임베더/특징 설정으로 만들어지는 벡터 차원 (헤더 "dims"와 같은 형식)"""
+    geo = normalize_latlon(None, None).size
+    human = human_feature_vector(CatMeta(image_path="")).size
+    return {"image": EMBED_DIM, "geo": geo, "human": human, "total": EMBED_DIM + geo + human}
+
+def check_gallery_header(header: Dict, embedder: str = EMBEDDER,
+                         dims: Optional[Dict[str, int]] = None) -> None:
+    """현재 설정으로 만든 쿼리와 비교 가능한 갤러리인지 확인. 아니면 ValueError"""
+    if header.get("format") != GALLERY_FORMAT:
+        raise ValueError(f"not a {GALLERY_FORMAT} file")
+    if header.get("version", 0) > GALLERY_VERSION:
+        raise ValueError(f"unsupported gallery version {header.get('version')} "
+                         f"(supported <= {GALLERY_VERSION})")
+    if header.get("embedder") != embedder:
+        raise ValueError(f"embedder mismatch: gallery={header.get('embedder')}, current={embedder}")
+    dims = dims if dims is not None else current_dims()
+    stored = header.get("dims") or {}
+    for key in ("geo", "human", "total"):
+        if stored.get(key) != dims[key]:
+            raise ValueError(f"dims mismatch ({key}): gallery={stored.get(key)}, current={dims[key]}")
+
+def make_gallery_header(data: Dict[str, np.ndarray], bounds=None, weights=DEFAULT_WEIGHTS,
+                        image_hashes: Optional[List[Optional[str]]] = None,
+                        human_dim: int = 0) -> Dict:
+    ids = list(data.keys())
+    total = int(next(iter(data.values())).shape[1]) if data else 0
+    geo_dim = normalize_latlon(None, None).size
+    return {
+        "format": GALLERY_FORMAT,
+        "version": GALLERY_VERSION,
+        "embedder": EMBEDDER,
+        "dims": {"image": max(total - geo_dim - human_dim, 0), "geo": geo_dim,
+                 "human": human_dim, "total": total},
+        "weights": [float(w) for w in weights],
+        "bounds": [float(b) for b in bounds] if bounds is not None else None,
+        "rows": int(sum(v.shape[0] for v in data.values())),
+        "ids": ids,
+        "image_sha256": list(image_hashes) if image_hashes is not None else [],
+        "checksum": gallery_checksum(data, ids),
+    }
+
+def gallery_checksum(data: Dict[str, np.ndarray], ids: List[str]) -> str:
+    """cat_id 순서대로 id와 float64 행렬 바이트를 이어 sha256"""
+    h = hashlib.sha256()
+    for k in ids:
+        h.update(k.encode("utf-8"))
+        h.update(np.ascontiguousarray(data[k], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def file_sha256(path: str) -> Optional[str]:
+    try:
+        return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    except OSError:
+        return None
 
 def cosine_top2(query: np.ndarray, mat: np.ndarray) -> Tuple[float,float]:
     sims = cosine_similarity(query.reshape(1,-1), mat)[0]  # (N,)
@@ -67,3 +163,124 @@ def match_query(query_vec: np.ndarray, gallery: Dict[str, np.ndarray],
     if best_sim < threshold or (best_sim - best_second) < margin:
         return "UNKNOWN", best_sim
     return best_id, best_sim
+
+def stack_gallery(gallery: Dict[str, np.ndarray]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """갤러리 dict를 (ids, (N,D) 행렬, identity별 시작 행 offsets)로 펼친다.
+
+    배치 매칭에서는 한 번만 만들어 match_ranked/match_multishot(stacked=...)로 재사용한다.
+    """
+    ids = list(gallery.keys())
+    mats = [np.atleast_2d(gallery[k]) for k in ids]
+    counts = np.array([m.shape[0] for m in mats], dtype=int)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    mat = np.vstack(mats) if mats else np.zeros((0, 0))
+    return ids, mat, offsets
+
+def per_identity_top2(sims: np.ndarray,
+                      offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """행 단위 유사도 (..., N) → identity별 (top1 sim, top2 sim, top1 행 번호), 각 (..., I).
+
+    정렬 없이 reduceat으로 top1을 구하고, top1 행만 제외해 한 번 더 reduceat → top2.
+    top2가 없는(사진 1장) identity의 top2는 cosine_top2와 같이 -1.0.
+    """
+    n = sims.shape[-1]
+    counts = np.diff(np.append(offsets, n))
+    best = np.maximum.reduceat(sims, offsets, axis=-1)
+    hit = sims == np.repeat(best, counts, axis=-1)
+    best_row = np.minimum.reduceat(np.where(hit, np.arange(n), n), offsets, axis=-1)
+    rest = np.array(sims, dtype=float)
+    np.put_along_axis(rest, best_row, -np.inf, axis=-1)
+    second = np.where(counts > 1, np.maximum.reduceat(rest, offsets, axis=-1), -1.0)
+    return best, second, best_row
+
+def open_set_decision(s1: np.ndarray, s2: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """identity별 (top1, top2) (..., I) → match_query와 같은 규칙의 (pred 인덱스, best_sim, best_second).
+
+    identity를 순서대로 보며 top1이 갱신될 때마다 그 identity의 top2를
+    best_second에 max로 누적하는 match_query 루프를 마지막 축에 벡터화한 것.
+    """
+    prev = np.maximum.accumulate(s1, axis=-1)
+    prev = np.concatenate([np.full(s1.shape[:-1] + (1,), -1.0), prev[..., :-1]], axis=-1)
+    best_second = np.max(np.where(s1 > prev, s2, -1.0), axis=-1)
+    return np.argmax(s1, axis=-1), s1.max(axis=-1), best_second
+
+def _top_k(ids: List[str], scores: np.ndarray, second: np.ndarray,
+           index: np.ndarray, k: int) -> List[Dict]:
+    """identity 점수 (I,)에서 상위 k개만 부분 정렬해 순위 목록 생성"""
+    k = min(k, len(ids))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return [{"cat_id": ids[i], "sim": float(scores[i]), "second": float(second[i]),
+             "index": int(index[i])} for i in top]
+
+def match_ranked(query_vec: np.ndarray, gallery: Dict[str, np.ndarray],
+                 threshold: float = 0.80, margin: float = 0.05, k: int = 0,
+                 stacked: Optional[Tuple[List[str], np.ndarray, np.ndarray]] = None) -> Tuple[str, float, List[Dict]]:
+    """match_query와 같은 open-set 판정과 상위 k개 순위를 한 번의 행렬곱 점수로 계산.
+
+    반환: (pred, best_sim, [{"cat_id", "sim"(identity 내 best), "second"(identity 내 2nd),
+    "index"(매칭된 사진의 identity 내 행 번호)}])
+    """
+    ids, mat, offsets = stacked if stacked is not None else stack_gallery(gallery)
+    if not ids:
+        return "UNKNOWN", -1.0, []
+    sims = cosine_similarity(query_vec.reshape(1,-1), mat)[0]  # (N,) 한 번의 행렬곱
+    best, second, best_row = per_identity_top2(sims, offsets)
+    pred, best_sim, best_second = open_set_decision(best, second)
+    ranking = _top_k(ids, best, second, best_row - offsets, k)
+    if best_sim < threshold or (best_sim - best_second) < margin:
+        return "UNKNOWN", float(best_sim), ranking
+    return ids[pred], float(best_sim), ranking
+
+MULTISHOT_MODES = ("max", "top_p", "set")
+
+def score_multishot(shot_vecs: np.ndarray, gallery: Dict[str, np.ndarray], mode: str = "top_p",
+                    p: float = 0.5, stacked=None) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """멀티샷 쿼리 (S, D)를 갤러리 전체와 한 번의 (S x N) 행렬곱으로 비교.
+
+    갤러리 사진(행)마다 샷 점수를 mode로 집계한 뒤, identity 점수/2순위/행 번호는
+    그 사진 점수의 top1/top2/argmax로 얻는다(단일 샷 매칭과 같은 구조, 항상 second <= sim).
+    mode (사진 한 장 g에 대한 점수):
+      - "max":   모든 샷 중 최고 유사도
+      - "top_p": 샷 유사도 중 상위 p 비율(최소 1장)의 평균 → 흐린 샷 배제
+      - "set":   샷 집합 ↔ {g} set-to-set(대칭 best-match 평균) = (샷 평균 + 샷 최고) / 2
+    반환: (ids, identity 점수 (I,), identity 내 2순위 사진 점수 (I,), best 사진의 identity 내 행 번호 (I,))
+    """
+    if mode not in MULTISHOT_MODES:
+        raise ValueError(f"unknown multi-shot mode: {mode} (choose from {MULTISHOT_MODES})")
+    ids, mat, offsets = stacked if stacked is not None else stack_gallery(gallery)
+    if not ids:
+        return ids, np.zeros(0), np.zeros(0), np.zeros(0, dtype=int)
+    sims = cosine_similarity(np.atleast_2d(shot_vecs), mat)  # (S, N)
+    if mode == "max":
+        row_scores = sims.max(axis=0)
+    elif mode == "top_p":
+        s = sims.shape[0]
+        n = min(s, max(1, int(np.ceil(p * s))))
+        row_scores = np.partition(sims, s - n, axis=0)[s - n:].mean(axis=0)
+    else:
+        row_scores = 0.5 * (sims.mean(axis=0) + sims.max(axis=0))
+    scores, second, best_row = per_identity_top2(row_scores, offsets)
+    return ids, scores, second, best_row - offsets
+
+def match_multishot(shot_vecs: np.ndarray, gallery: Dict[str, np.ndarray], mode: str = "top_p",
+                    p: float = 0.5, threshold: float = 0.80, id_margin: float = 0.05,
+                    k: int = 0, stacked=None) -> Tuple[str, float, List[Dict]]:
+    """멀티샷 open-set 매칭. 집계 점수는 identity 내 2순위 사진과 척도가 달라
+    id_margin(1위와 2위 identity 점수 차이)으로 판정한다.
+
+    반환: (pred, best 점수, 상위 k개 [{"cat_id", "sim", "second", "index"}])
+    """
+    ids, scores, second, best_index = score_multishot(shot_vecs, gallery, mode=mode, p=p,
+                                                      stacked=stacked)
+    if not ids:
+        return "UNKNOWN", -1.0, []
+    top2 = _top_k(ids, scores, second, best_index, 2)
+    best_sim = top2[0]["sim"]
+    runner_up = top2[1]["sim"] if len(top2) > 1 else -1.0
+    ranking = _top_k(ids, scores, second, best_index, k)
+    if best_sim < threshold or (best_sim - runner_up) < id_margin:
+        return "UNKNOWN", best_sim, ranking
+    return top2[0]["cat_id"], best_sim, ranking
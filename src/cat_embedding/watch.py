@@ -0,0 +1,392 @@
+# src/cat_embedding/watch.py
+import asyncio, json, os, sys, time, numpy as np
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Optional
+from PIL import Image
+from sklearn.metrics.pairwise import cosine_similarity
+
+from .schema import CatMeta
+from .features import human_feature_vector
+from .gallery import (build_vectors, stack_gallery, per_identity_top2, open_set_decision,
+                      load_gallery, read_gallery_header, make_gallery_header, save_gallery,
+                      file_sha256, DEFAULT_WEIGHTS)
+
+# inotify 등 OS 이벤트(watchdog) 사용, 미설치 시 폴링으로 대체
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+DONE_DIR, FAILED_DIR = "processed", "failed"
+
+class FolderWatcher:
+    """watch 폴더에 들어온 이미지(+ 같은 이름의 .json 사이드카)를 묶어서 매칭/등록.
+
+    - scanner: 이벤트(또는 poll 주기)마다 폴더를 훑어 안정화된 파일을 bounded queue에 넣음.
+      queue가 가득 차면 scanner가 멈추고 파일은 디스크에 남는다(backpressure).
+    - worker: window 초 또는 batch_size 건까지 모아 한 번에 임베딩(warm model)하고,
+      배치 전체를 stack_gallery 행렬과 한 번에 비교한 뒤 순서대로 판정.
+      UNKNOWN은 새 cat_id로 갤러리에 추가한다. 메타데이터는 배치마다 JSONL에 바로 append하고
+      (내구성 있는 로그, 행마다 image_sha256 포함), 갤러리 npz 전체 재작성은
+      flush_interval 초에 한 번 + 종료 시 한 번만 한다. 그 사이 비정상 종료되면 다음 시작 때
+      갤러리에 없는 JSONL 행을 다시 임베딩해 복구한다.
+    처리된 파일은 processed/, 읽을 수 없는 파일은 failed/ 로 이동한다(이름 앞에 sha256 접두어).
+    사이드카 없는 이미지는 sidecar_wait 초 더 기다리고, orphan_after 초가 지나도 짝이 되는
+    이미지가 없는 사이드카(늦게 도착했거나 이미지가 안 온 경우)는 로그를 남기고 failed/로 옮긴다.
+    """
+
+    def __init__(self, watch_dir: str, gallery_path: str, meta_path: str = "ingested.jsonl",
+                 bounds=None, threshold: float = 0.80, margin: float = 0.05,
+                 window: float = 2.0, batch_size: int = 32, max_pending: int = 256,
+                 poll: float = 1.0, settle: float = 1.0, append_matches: bool = False,
+                 flush_interval: float = 30.0, sidecar_wait: float = 2.0,
+                 orphan_after: float = 60.0):
+        self.watch_dir = Path(watch_dir)
+        self.gallery_path = gallery_path
+        self.meta_path = Path(meta_path)
+        self.threshold, self.margin = threshold, margin
+        self.window, self.batch_size, self.max_pending = window, batch_size, max_pending
+        self.poll, self.settle = poll, settle
+        self.sidecar_wait, self.orphan_after = sidecar_wait, orphan_after
+        self.append_matches = append_matches
+        self.flush_interval = flush_interval
+        self.in_flight = set()  # queue에 들어갔지만 아직 처리 안 된 파일(최대 max_pending + batch_size)
+        self.dirty, self.last_flush = False, time.monotonic()  # 디스크의 갤러리보다 메모리가 앞서 있는지
+        self._load_state(bounds)
+        self._replay_log()
+
+    def _load_state(self, bounds):
+        header = read_gallery_header(self.gallery_path) if os.path.exists(self.gallery_path) else None
+        self.headered = header is not None
+        if header is None:
+            self.gallery = load_gallery(self.gallery_path) if os.path.exists(self.gallery_path) else {}
+            self.bounds, self.weights = bounds, DEFAULT_WEIGHTS
+            self.hashes = {k: [None] * len(v) for k, v in self.gallery.items()}
+        else:
+            # 이 내용으로 파일을 다시 쓰므로, 손상된 갤러리를 덮어쓰기 전에 checksum 확인
+            self.gallery = load_gallery(self.gallery_path, verify=True)
+            self.bounds, self.weights = header["bounds"], tuple(header["weights"])
+            it = iter(header["image_sha256"] or [None] * header["rows"])
+            self.hashes = {k: [next(it, None) for _ in range(len(self.gallery[k]))] for k in header["ids"]}
+
+    def _replay_log(self):
+        """마지막 flush 이후 JSONL에만 기록된 행(비정상 종료)을 갤러리에 다시 반영.
+
+        sha256 개수로 대조하므로 헤더(image_sha256)가 있는 갤러리에서만 동작한다.
+        """
+        if not self.headered or not self.meta_path.exists():
+            return
+        have = Counter(h for hs in self.hashes.values() for h in hs if h)
+        missing = []
+        for line in self.meta_path.read_text(encoding="utf-8").splitlines():
+            if not line.strip():
+                continue
+            raw = json.loads(line)
+            sha = raw.get("image_sha256")
+            if sha is None:
+                continue
+            if have[sha] > 0:
+                have[sha] -= 1
+            elif not os.path.exists(raw["image_path"]):
+                print(f"⚠️  복구할 이미지가 없습니다: {raw['image_path']}", file=sys.stderr)
+            else:
+                missing.append((CatMeta(**raw), sha))
+        if not missing:
+            return
+        vecs = build_vectors([m for m, _ in missing], bounds=self.bounds, weights=self.weights)
+        for (m, sha), v in zip(missing, vecs):
+            self._append(m.cat_id, v, sha)
+        print(f"♻️  {self.meta_path}에서 {len(missing)}건을 갤러리로 복구", file=sys.stderr)
+        self.dirty = True
+        self.flush()
+
+    # ---- scanner -----------------------------------------------------------------
+
+    def ready_files(self, limit: int) -> List[Path]:
+        """안정화(settle 초 동안 변경 없음)된 새 이미지를 최대 limit개 반환(그 안에서 오래된 것부터).
+
+        사이드카가 없는 이미지는 같은 이름의 .json이 뒤따라 올 수 있으므로 sidecar_wait 초 더 기다린다.
+        limit개를 채우면 더 훑지 않으므로 폴더에 쌓인 양과 무관하게 메모리가 제한된다.
+        """
+        now = time.time()
+        found = []
+        try:
+            with os.scandir(self.watch_dir) as it:
+                for entry in it:
+                    p = Path(entry.path)
+                    if p.suffix.lower() == ".json":
+                        self._check_orphan(entry, now)
+                        continue
+                    if p.suffix.lower() not in IMAGE_SUFFIXES or p in self.in_flight:
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        mtime = entry.stat().st_mtime
+                        side = p.with_suffix(".json")
+                        if side.exists():
+                            mtime, wait = max(mtime, side.stat().st_mtime), self.settle
+                        else:
+                            wait = self.settle + self.sidecar_wait
+                    except OSError:
+                        continue  # 훑는 사이에 worker가 옮긴 파일
+                    if now - mtime >= wait:
+                        found.append((mtime, p))
+                        if len(found) >= limit:
+                            break
+        except OSError as e:
+            print(f"❌ 폴더를 읽을 수 없습니다: {e}", file=sys.stderr)
+        return [p for _, p in sorted(found)]
+
+    def _check_orphan(self, entry: os.DirEntry, now: float):
+        """orphan_after 초가 지나도 같은 이름의 이미지가 없는 사이드카는 failed/로 옮김"""
+        p = Path(entry.path)
+        try:
+            if now - entry.stat().st_mtime < self.orphan_after:
+                return
+            suffixes = IMAGE_SUFFIXES + tuple(x.upper() for x in IMAGE_SUFFIXES)
+            if any(p.with_suffix(x).exists() for x in suffixes):
+                return
+            dest = self._move(p, FAILED_DIR)
+        except OSError:
+            return  # 그 사이 옮겨졌거나 지워진 파일
+        print(f"⚠️  짝이 되는 이미지가 없는 사이드카 {p.name} → {dest}", file=sys.stderr)
+
+    async def scan(self, queue: asyncio.Queue, wake: asyncio.Event, once: bool = False):
+        while True:
+            wake.clear()
+            # 빈 자리만큼만 훑고, 가득 차 있으면 1개를 put하며 대기 → backpressure
+            free = max(self.max_pending - queue.qsize(), 1)
+            found = self.ready_files(limit=free)
+            for p in found:
+                self.in_flight.add(p)
+                await queue.put(p)
+            if len(found) >= free:
+                continue  # 아직 남은 파일이 있을 수 있음
+            if once:
+                await queue.put(None)
+                return
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=self.poll)
+            except asyncio.TimeoutError:
+                pass
+
+    # ---- worker ------------------------------------------------------------------
+
+    async def work(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            first = await queue.get()
+            if first is None:
+                return
+            batch, deadline = [first], loop.time() + self.window
+            while len(batch) < self.batch_size:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            # 임베딩/저장은 블로킹이므로 executor에서 실행(그동안 scanner는 계속 동작)
+            try:
+                await loop.run_in_executor(None, self.process_batch, batch)
+            except Exception as e:
+                # 한 장(예: 잘린 JPEG) 때문에 배치 전체가 실패할 수 있으므로 한 장씩 다시 처리
+                print(f"❌ 배치 처리 실패({len(batch)}건), 한 장씩 재시도: {e}", file=sys.stderr)
+                await loop.run_in_executor(None, self.process_each, batch)
+
+    def process_each(self, paths: List[Path]):
+        """배치 실패 후 재시도: 한 장씩 처리하고, 그래도 실패한 파일만 failed/로 이동"""
+        for p in paths:
+            if not p.exists():  # 이미 failed/processed로 옮겨진 파일
+                self.in_flight.discard(p)
+                continue
+            try:
+                self.process_batch([p])
+            except Exception as e:
+                print(f"❌ {p.name} 처리 실패: {e}", file=sys.stderr)
+                if p.exists():
+                    self._move(p, FAILED_DIR)
+                self.in_flight.discard(p)
+
+    def process_batch(self, paths: List[Path]) -> List[Dict]:
+        metas, ok = [], []
+        for p in paths:
+            meta = self._load_meta(p)
+            if meta is None:
+                self._move(p, FAILED_DIR)
+                continue
+            metas.append(meta)
+            ok.append(p)
+        if not metas:
+            return []
+        vecs = build_vectors(metas, bounds=self.bounds, weights=self.weights)
+        shas = [file_sha256(str(p)) for p in ok]
+        decisions = self._match_batch(vecs)
+        added, results = [], []
+        for i, (p, (pred, sim, cat_id, action)) in enumerate(zip(ok, decisions)):
+            if action in ("new", "appended"):
+                self._append(cat_id, vecs[i], shas[i])
+                added.append(i)
+            results.append({"image_path": p.name, "pred": pred, "sim": round(float(sim),4),
+                            "cat_id": cat_id, "action": action})
+        # 이름이 겹쳐도(IMG_0001.jpg 등) 덮어쓰지 않도록 고유한 이름으로 이동 후 그 경로를 기록
+        dests = [self._move(p, DONE_DIR, shas[i]) for i, p in enumerate(ok)]
+        if added:
+            self._persist([(metas[i].model_copy(update={"cat_id": decisions[i][2],
+                                                        "image_path": str(dests[i])}), shas[i])
+                           for i in added])
+        for r in results:
+            print(json.dumps(r, ensure_ascii=False), flush=True)
+        return results
+
+    def _match_batch(self, vecs: np.ndarray) -> List[tuple]:
+        """배치 (B, D)를 갤러리와 한 번의 행렬곱으로 비교해 순서대로 판정.
+
+        앞선 사진이 새 개체/추가 사진으로 등록되면 뒤 사진의 identity별 top1/top2에
+        배치 내 유사도(B x B)로 반영하므로, 사진마다 갤러리를 다시 훑지 않으면서도
+        match_query를 한 장씩 호출하며 갤러리를 갱신한 것과 같은 결과가 된다.
+        반환: [(pred, sim, cat_id, action)]
+        """
+        ids, mat, offsets = stack_gallery(self.gallery)
+        ids = list(ids)
+        n_base = len(ids)
+        if n_base:
+            base_s1, base_s2, _ = per_identity_top2(cosine_similarity(vecs, mat), offsets)
+        else:
+            base_s1 = base_s2 = np.zeros((len(vecs), 0))
+        within = cosine_similarity(vecs, vecs)
+        added: List[tuple] = []  # (배치 내 행, identity 인덱스)
+        decisions = []
+        for j in range(len(vecs)):
+            s1 = np.concatenate([base_s1[j], np.full(len(ids) - n_base, -1.0)])
+            s2 = np.concatenate([base_s2[j], np.full(len(ids) - n_base, -1.0)])
+            for r, k in added:
+                v = within[j, r]
+                if v > s1[k]:
+                    s1[k], s2[k] = v, s1[k]
+                elif v > s2[k]:
+                    s2[k] = v
+            if len(ids):
+                idx, best_sim, best_second = open_set_decision(s1, s2)
+                best_sim = float(best_sim)
+                unknown = best_sim < self.threshold or (best_sim - best_second) < self.margin
+                pred = "UNKNOWN" if unknown else ids[idx]
+            else:
+                pred, best_sim = "UNKNOWN", -1.0
+            if pred == "UNKNOWN" and best_sim < self.threshold:
+                cat_id, action = self._next_id(ids), "new"
+                ids.append(cat_id)
+                added.append((j, len(ids) - 1))
+            elif pred != "UNKNOWN" and self.append_matches:
+                cat_id, action = pred, "appended"
+                added.append((j, ids.index(pred)))
+            else:
+                cat_id, action = pred, "matched" if pred != "UNKNOWN" else "ambiguous"
+            decisions.append((pred, best_sim, cat_id, action))
+        return decisions
+
+    def _load_meta(self, p: Path) -> Optional[CatMeta]:
+        try:
+            with Image.open(p) as img:
+                img.verify()  # 전송 중 잘린 파일 배제(픽셀 fallback은 오류 시 랜덤 벡터를 냄)
+            side = p.with_suffix(".json")
+            extra = json.loads(side.read_text(encoding="utf-8")) if side.exists() else {}
+            extra.pop("cat_id", None)
+            return CatMeta(**{**extra, "image_path": str(p)})
+        except Exception as e:
+            print(f"❌ {p.name} 처리 불가: {e}", file=sys.stderr)
+            return None
+
+    def _next_id(self, taken: List[str]) -> str:
+        n = len(taken) + 1
+        while f"cat_{n:03d}" in taken:
+            n += 1
+        return f"cat_{n:03d}"
+
+    def _append(self, cat_id: str, vec: np.ndarray, sha: Optional[str]):
+        old = self.gallery.get(cat_id)
+        self.gallery[cat_id] = vec[None, :] if old is None else np.vstack([old, vec])
+        self.hashes.setdefault(cat_id, []).append(sha)
+
+    def _persist(self, new_rows: List[tuple]):
+        """[(CatMeta, sha256)] → JSONL에 즉시 append, 갤러리 재작성은 flush_interval마다"""
+        with open(self.meta_path, "a", encoding="utf-8") as f:
+            for m, sha in new_rows:
+                f.write(json.dumps({**m.model_dump(mode="json"), "image_sha256": sha},
+                                   ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.dirty = True
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """변경된 갤러리를 임시 파일에 쓴 뒤 교체(전체 재작성). 변경이 없으면 아무것도 안 함"""
+        if not self.dirty:
+            return
+        header = make_gallery_header(self.gallery, bounds=self.bounds, weights=self.weights,
+                                     image_hashes=[h for k in self.gallery for h in self.hashes[k]],
+                                     human_dim=human_feature_vector(CatMeta(image_path="")).size)
+        tmp = f"{self.gallery_path}.tmp.npz"
+        save_gallery(tmp, self.gallery, header)
+        os.replace(tmp, self.gallery_path)
+        self.dirty, self.last_flush = False, time.monotonic()
+
+    def _move(self, p: Path, sub: str, sha: Optional[str] = None) -> Path:
+        """이미지(+사이드카)를 sub/ 로 옮기고 새 이미지 경로 반환. 이름은 sha256 접두어로 고유하게"""
+        dest = self.watch_dir / sub
+        dest.mkdir(exist_ok=True)
+        prefix = (sha or file_sha256(str(p)) or "nohash")[:12]
+        stem = f"{prefix}_{p.stem}"
+        n = 1
+        while (dest / (stem + p.suffix)).exists() or (dest / (stem + ".json")).exists():
+            n += 1
+            stem = f"{prefix}_{p.stem}_{n}"
+        target = dest / (stem + p.suffix)
+        side = p.with_suffix(".json")
+        if side.exists():
+            os.replace(side, dest / (stem + ".json"))
+        if p.exists():
+            os.replace(p, target)
+        self.in_flight.discard(p)
+        return target
+
+    # ---- entry -------------------------------------------------------------------
+
+    async def run(self, once: bool = False):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_pending)
+        wake = asyncio.Event()
+        observer = None
+        if WATCHDOG_AVAILABLE and not once:
+            loop = asyncio.get_running_loop()
+
+            class _Wake(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    loop.call_soon_threadsafe(wake.set)
+
+            observer = Observer()
+            observer.schedule(_Wake(), str(self.watch_dir), recursive=False)
+            observer.start()
+        try:
+            await asyncio.gather(self.scan(queue, wake, once=once), self.work(queue))
+            self.flush()
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+def watch_folder(watch_dir: str, gallery_path: str, once: bool = False, **kwargs):
+    watcher = FolderWatcher(watch_dir, gallery_path, **kwargs)
+    try:
+        asyncio.run(watcher.run(once=once))
+    finally:
+        # Ctrl+C 등으로 중단돼도 executor가 끝난 뒤 남은 변경을 한 번 저장
+        watcher.flush()
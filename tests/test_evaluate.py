@@ -0,0 +1,82 @@
+import numpy as np
+
+from cat_embedding.schema import CatMeta
+from cat_embedding import evaluate as E
+from cat_embedding.gallery import match_query, stack_gallery, per_identity_top2, open_set_decision
+from cat_embedding.evaluate import sweep_open_set, split_rows
+
+
+def _random_gallery(rng, n_ids=5, dim=8):
+    gal = {}
+    for i in range(n_ids):
+        m = rng.normal(size=(int(rng.integers(1, 4)), dim))
+        gal[f"cat_{i}"] = m / np.linalg.norm(m, axis=1, keepdims=True)
+    return gal
+
+
+def test_batched_open_set_decision_matches_match_query_loop():
+    rng = np.random.default_rng(3)
+    gal = _random_gallery(rng)
+    ids, mat, offsets = stack_gallery(gal)
+    queries = rng.normal(size=(20, 8))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    s1, s2, _ = per_identity_top2(queries @ mat.T, offsets)
+    pred, best_sim, best_second = open_set_decision(s1, s2)
+    for thr, margin in [(0.0, 0.0), (0.3, 0.05), (0.5, 0.2)]:
+        accept = (best_sim >= thr) & (best_sim - best_second >= margin)
+        for qi, q in enumerate(queries):
+            exp_pred, exp_sim = match_query(q, gal, threshold=thr, margin=margin)
+            assert np.isclose(best_sim[qi], exp_sim)
+            assert (ids[pred[qi]] if accept[qi] else "UNKNOWN") == exp_pred
+
+
+def test_sweep_open_set_counts():
+    correct = np.array([True, False, True, False])
+    known = np.array([True, True, True, False])
+    best_sim = np.array([0.9, 0.85, 0.7, 0.82])
+    best_second = np.array([0.5, 0.5, 0.68, 0.5])
+    sweep = sweep_open_set(correct, known, best_sim, best_second, [0.8, 0.6], [0.0, 0.05])
+    got = {(r["thr"], r["margin"]): (r["tpr"], r["fpr"]) for r in sweep}
+    assert got[(0.8, 0.0)] == (round(1 / 3, 4), 1.0)
+    assert got[(0.6, 0.0)] == (round(2 / 3, 4), 1.0)
+    assert got[(0.6, 0.05)] == (round(1 / 3, 4), 1.0)
+
+
+def test_split_rows_per_id_and_holdout():
+    rows = [(CatMeta(cat_id=f"c{i}", image_path=f"{i}_{j}.jpg"), None)
+            for i in range(5) for j in range(3)]
+    gal, qry = split_rows(rows, per_id=1, holdout=0.4, seed=0)
+    gal_ids = {m.cat_id for m in gal}
+    assert len(gal) == 3 and len(gal_ids) == 3
+    assert len(qry) == 12
+    assert sum(m.cat_id not in gal_ids for m in qry) == 6
+
+    rows = [(CatMeta(cat_id="a", image_path="x.jpg"), "gallery"),
+            (CatMeta(cat_id="a", image_path="y.jpg"), "query")]
+    gal, qry = split_rows(rows)
+    assert [m.image_path for m in gal] == ["x.jpg"] and [m.image_path for m in qry] == ["y.jpg"]
+
+
+def test_evaluate_end_to_end(monkeypatch):
+    # 이미지 이름 첫 글자로 벡터 지정: a → e1, b/x → e2(x는 b로 오인되는 a 사진), c → e3
+    basis = {"a": [1.0, 0, 0], "b": [0, 1.0, 0], "x": [0, 1.0, 0], "c": [0, 0, 1.0]}
+    monkeypatch.setattr(E, "build_vectors", lambda metas, bounds=None, weights=None: np.array(
+        [basis[m.image_path[0]] for m in metas]))
+    rows = [(CatMeta(cat_id="a", image_path="a1.jpg"), "gallery"),
+            (CatMeta(cat_id="b", image_path="b1.jpg"), "gallery"),
+            (CatMeta(cat_id="a", image_path="a2.jpg"), "query"),
+            (CatMeta(cat_id="a", image_path="x3.jpg"), "query"),
+            (CatMeta(cat_id="b", image_path="b2.jpg"), "query"),
+            (CatMeta(cat_id="b", image_path="b3.jpg"), "query")] + \
+           [(CatMeta(cat_id="c", image_path=f"c{i}.jpg"), "query") for i in range(3)]
+
+    report = E.evaluate(rows, thresholds=[0.5, 1.01], margins=[0.0], batch_size=2)
+
+    assert report["n_gallery"] == 2 and report["n_ids"] == 2
+    assert report["n_known"] == 4 and report["n_unknown"] == 3
+    assert report["rank1"] == 0.75
+    sweep = {r["thr"]: r for r in report["sweep"]}
+    assert (sweep[0.5]["tpr"], sweep[0.5]["fpr"]) == (0.75, 0.0)
+    assert (sweep[1.01]["tpr"], sweep[1.01]["fpr"]) == (0.0, 0.0)
+    assert report["qps"]["match"] > 0
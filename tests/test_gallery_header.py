@@ -0,0 +1,78 @@
+import argparse
+
+import numpy as np
+import pytest
+
+from cat_embedding import gallery as G
+from cat_embedding.__main__ import weights_arg
+
+
+def _data():
+    rng = np.random.default_rng(1)
+    return {"cat_001": rng.normal(size=(2, 6)), "cat_002": rng.normal(size=(1, 6))}
+
+
+def test_header_roundtrip_and_verify(tmp_path):
+    path = str(tmp_path / "g.npz")
+    data = _data()
+    header = G.make_gallery_header(data, bounds=(37.0, 38.0, 126.0, 127.0),
+                                   image_hashes=["a", "b", "c"], human_dim=2)
+    G.save_gallery(path, data, header)
+
+    h = G.read_gallery_header(path)
+    assert h["format"] == G.GALLERY_FORMAT and h["version"] == G.GALLERY_VERSION
+    assert h["rows"] == 3 and h["ids"] == ["cat_001", "cat_002"]
+    assert h["dims"] == {"image": 2, "geo": 2, "human": 2, "total": 6}
+    assert h["bounds"] == [37.0, 38.0, 126.0, 127.0]
+    assert h["weights"] == list(G.DEFAULT_WEIGHTS)
+    G.check_gallery_header(h, dims={"geo": 2, "human": 2, "total": 6})
+
+    gal = G.load_gallery(path, verify=True)
+    assert G.HEADER_KEY not in gal
+    assert np.array_equal(gal["cat_001"], data["cat_001"])
+
+
+def test_checksum_mismatch_detected(tmp_path):
+    path = str(tmp_path / "g.npz")
+    data = _data()
+    header = G.make_gallery_header(data)
+    data["cat_002"] = data["cat_002"] + 1.0  # 헤더 작성 후 데이터 변경
+    G.save_gallery(path, data, header)
+    with pytest.raises(ValueError, match="checksum"):
+        G.load_gallery(path, verify=True)
+
+
+def test_check_header_rejects_incompatible_gallery():
+    header = G.make_gallery_header(_data())
+    with pytest.raises(ValueError, match="embedder"):
+        G.check_gallery_header(header, embedder="something-else")
+    with pytest.raises(ValueError, match="version"):
+        G.check_gallery_header({**header, "version": G.GALLERY_VERSION + 1})
+
+
+def test_check_header_rejects_dims_mismatch():
+    dims = G.current_dims()
+    ok = G.make_gallery_header({"cat_001": np.zeros((1, dims["total"]))}, human_dim=dims["human"])
+    G.check_gallery_header(ok)
+
+    # 5차원 갤러리(예: 다른 설정으로 만든 파일)는 sklearn 오류 대신 명확한 ValueError
+    small = G.make_gallery_header({"cat_001": np.zeros((1, 5))}, human_dim=1)
+    with pytest.raises(ValueError, match="dims mismatch"):
+        G.check_gallery_header(small)
+    # 특징 벡터 구성만 바뀐 경우(전체 차원은 같아도)도 거부
+    with pytest.raises(ValueError, match="human"):
+        G.check_gallery_header({**ok, "dims": {**ok["dims"], "human": dims["human"] + 1}})
+
+
+def test_legacy_gallery_has_no_header(tmp_path):
+    path = str(tmp_path / "legacy.npz")
+    np.savez_compressed(path, **_data())
+    assert G.read_gallery_header(path) is None
+    assert set(G.load_gallery(path, verify=True)) == {"cat_001", "cat_002"}
+
+
+def test_weights_arg_requires_three_numbers():
+    assert weights_arg("[0.8, 0.1, 0.1]") == (0.8, 0.1, 0.1)
+    for bad in ("[0.9, 0.1]", "[0.7, 0.1, 0.1, 0.1]", '["a", 0.1, 0.1]', "0.85"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            weights_arg(bad)
@@ -0,0 +1,121 @@
+import numpy as np
+
+from cat_embedding.gallery import (stack_gallery, per_identity_top2,
+                                   match_query, match_ranked, score_multishot,
+                                   match_multishot)
+
+
+def _unit(*xs):
+    v = np.array(xs, dtype=float)
+    return v / np.linalg.norm(v)
+
+
+def _gallery():
+    return {
+        "cat_a": np.vstack([_unit(1, 0, 0), _unit(1, 1, 0)]),
+        "cat_b": np.vstack([_unit(0, 1, 0)]),
+        "cat_c": np.vstack([_unit(0, 0, 1), _unit(1, 0, 1), _unit(1, 0.1, 0)]),
+    }
+
+
+def test_match_ranked_orders_identities_with_per_identity_scores():
+    q = _unit(1, 0, 0)
+    _, _, ranking = match_ranked(q, _gallery(), k=3)
+
+    assert [r["cat_id"] for r in ranking] == ["cat_a", "cat_c", "cat_b"]
+    top = ranking[0]
+    assert np.isclose(top["sim"], 1.0)
+    assert np.isclose(top["second"], _unit(1, 1, 0)[0])
+    assert top["index"] == 0
+    # cat_c: 세 번째 사진(index 2)이 best
+    assert ranking[1]["index"] == 2
+    # 사진 1장인 identity는 second = -1.0
+    assert ranking[2]["second"] == -1.0
+
+
+def test_match_ranked_truncates_k_and_reuses_stacked():
+    gal = _gallery()
+    stacked = stack_gallery(gal)
+    q = _unit(0, 1, 0)
+    assert [r["cat_id"] for r in match_ranked(q, gal, k=1, stacked=stacked)[2]] == ["cat_b"]
+    assert len(match_ranked(q, gal, k=10, stacked=stacked)[2]) == 3
+    assert match_ranked(q, {}, k=3) == ("UNKNOWN", -1.0, [])
+
+
+def test_per_identity_top2_matches_bruteforce():
+    rng = np.random.default_rng(0)
+    gal = {f"cat_{i}": rng.normal(size=(int(rng.integers(1, 5)), 4)) for i in range(6)}
+    ids, mat, offsets = stack_gallery(gal)
+    sims = rng.normal(size=mat.shape[0])
+    best, second, best_row = per_identity_top2(sims, offsets)
+    for i, k in enumerate(ids):
+        seg = sims[offsets[i]:offsets[i] + len(gal[k])]
+        s = np.sort(seg)[::-1]
+        assert best[i] == s[0]
+        assert second[i] == (s[1] if len(s) > 1 else -1.0)
+        assert sims[best_row[i]] == s[0]
+
+
+def test_match_ranked_agrees_with_match_query():
+    rng = np.random.default_rng(5)
+    gal = {f"cat_{i}": rng.normal(size=(int(rng.integers(1, 4)), 6)) for i in range(6)}
+    stacked = stack_gallery(gal)
+    for q in rng.normal(size=(25, 6)):
+        for thr, margin in [(0.0, 0.0), (0.3, 0.05), (0.6, 0.2)]:
+            pred, sim, ranking = match_ranked(q, gal, threshold=thr, margin=margin, k=2,
+                                              stacked=stacked)
+            exp_pred, exp_sim = match_query(q, gal, threshold=thr, margin=margin)
+            assert pred == exp_pred and np.isclose(sim, exp_sim)
+            assert np.isclose(ranking[0]["sim"], sim)
+
+
+def test_score_multishot_modes():
+    gal = {"cat_a": _gallery()["cat_a"], "cat_b": _gallery()["cat_b"],
+           "cat_c": np.vstack([_unit(0, 0, 1)])}
+    # 선명한 샷 2장 + 흐린(엉뚱한) 샷 1장
+    shots = np.vstack([_unit(1, 0, 0), _unit(1, 0.05, 0), _unit(0, 0, 1)])
+    ids, mx, second, _ = score_multishot(shots, gal, mode="max")
+    _, tp, _, idx = score_multishot(shots, gal, mode="top_p", p=0.6)
+    _, st, _, _ = score_multishot(shots, gal, mode="set")
+    a, c = ids.index("cat_a"), ids.index("cat_c")
+
+    assert np.isclose(mx[c], 1.0)  # max는 흐린 샷 하나로도 cat_c 만점
+    assert tp[a] > tp[c]           # top_p는 상위 2장 평균 → cat_a 우세
+    assert idx[a] == 0
+    # cat_a 2순위 사진(1,1,0)의 샷 중 최고 유사도, 사진 1장인 cat_c는 -1.0
+    assert np.isclose(second[a], _unit(1, 1, 0) @ _unit(1, 0.05, 0))
+    assert second[c] == -1.0
+    assert st.shape == (3,) and np.all(st <= 1.0 + 1e-9)
+
+
+def test_match_multishot_open_set_and_ranking():
+    gal = _gallery()
+    shots = np.vstack([_unit(0, 1, 0), _unit(0, 1, 0.05)])
+    pred, sim, ranking = match_multishot(shots, gal, mode="top_p", p=1.0, k=2)
+    assert pred == "cat_b" and sim > 0.99
+    assert [r["cat_id"] for r in ranking][0] == "cat_b" and len(ranking) == 2
+    assert set(ranking[0]) == {"cat_id", "sim", "second", "index"}
+
+    pred, _, ranking = match_multishot(shots, gal, mode="max", threshold=1.01, k=1)
+    assert pred == "UNKNOWN" and ranking[0]["cat_id"] == "cat_b"
+
+    # 2위 개체와의 차이가 id_margin보다 작으면 UNKNOWN
+    pred, _, _ = match_multishot(shots, gal, mode="max", threshold=0.0, id_margin=0.99)
+    assert pred == "UNKNOWN"
+
+
+def test_multishot_second_never_exceeds_sim():
+    # 리뷰 예시: top_p(p=1)에서 예전에는 sim=0.5, second=0.707이 나왔음
+    gal = {"a": np.vstack([_unit(1, 0, 0), _unit(1, 1, 0)])}
+    shots = np.vstack([_unit(1, 0, 0), _unit(0, 0, 1)])
+    _, _, ranking = match_multishot(shots, gal, mode="top_p", p=1.0, k=1)
+    assert np.isclose(ranking[0]["sim"], 0.5)
+    assert np.isclose(ranking[0]["second"], 0.5 * _unit(1, 1, 0)[0])
+    assert ranking[0]["index"] == 0
+
+    rng = np.random.default_rng(11)
+    gal = {f"cat_{i}": rng.normal(size=(int(rng.integers(1, 5)), 6)) for i in range(8)}
+    shots = rng.normal(size=(5, 6))
+    for mode in ("max", "top_p", "set"):
+        _, scores, second, _ = score_multishot(shots, gal, mode=mode, p=0.4)
+        assert np.all(second <= scores)
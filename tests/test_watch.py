@@ -0,0 +1,237 @@
+import asyncio
+import json
+import os
+import re
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from cat_embedding import watch
+from cat_embedding.gallery import (read_gallery_header, load_gallery, make_gallery_header,
+                                   save_gallery, match_query)
+
+
+def _make_image(path, color):
+    Image.new("RGB", (8, 8), color).save(path)
+    os.utime(path, (0, 0))  # settle 시간 경과한 것으로 취급
+
+
+def _stub_vectors(monkeypatch):
+    # 파일 이름 첫 글자로 개체 구분: a*, b* → 서로 직교하는 벡터 (processed/의 sha 접두어는 무시)
+    basis = {"a": np.array([1.0, 0, 0]), "b": np.array([0, 1.0, 0])}
+
+    def name(m):
+        return re.sub(r"^[0-9a-f]{12}_", "", os.path.basename(m.image_path))
+
+    monkeypatch.setattr(watch, "build_vectors",
+                        lambda metas, bounds=None, weights=None: np.vstack(
+                            [basis[name(m)[0]] for m in metas]))
+
+
+def test_watch_once_registers_new_identities(monkeypatch, tmp_path):
+    _stub_vectors(monkeypatch)
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    _make_image(inbox / "a1.jpg", (255, 0, 0))
+    _make_image(inbox / "a2.jpg", (255, 0, 0))
+    _make_image(inbox / "b1.jpg", (0, 0, 255))
+    (inbox / "b1.json").write_text(json.dumps({"coat_type": "tuxedo"}), encoding="utf-8")
+    os.utime(inbox / "b1.json", (0, 0))
+    (inbox / "broken.jpg").write_text("not an image")
+    os.utime(inbox / "broken.jpg", (0, 0))
+
+    gallery_path = str(tmp_path / "g.npz")
+    meta_path = tmp_path / "ingested.jsonl"
+    watch.watch_folder(str(inbox), gallery_path, once=True, meta_path=str(meta_path))
+
+    # a1 → 새 개체, a2 → 같은 배치에서 방금 등록된 a1과 매칭, b1 → 새 개체
+    rows = [json.loads(x) for x in meta_path.read_text(encoding="utf-8").splitlines()]
+    assert [r["cat_id"] for r in rows] == ["cat_001", "cat_002"]
+    assert rows[1]["coat_type"] == "tuxedo"
+    header = read_gallery_header(gallery_path)
+    assert header["ids"] == ["cat_001", "cat_002"] and header["rows"] == 2
+    load_gallery(gallery_path, verify=True)
+
+    # 이동된 파일은 "<sha256 12자리>_원래이름"
+    assert sorted(n.split("_", 1)[1] for n in os.listdir(inbox / "processed")) == \
+        ["a1.jpg", "a2.jpg", "b1.jpg", "b1.json"]
+    assert [n.split("_", 1)[1] for n in os.listdir(inbox / "failed")] == ["broken.jpg"]
+    assert all(os.path.exists(r["image_path"]) for r in rows)
+
+
+def test_scanner_blocks_when_queue_full(tmp_path):
+    for i in range(5):
+        _make_image(tmp_path / f"a{i}.jpg", (i, i, i))
+    watcher = watch.FolderWatcher(str(tmp_path), str(tmp_path / "g.npz"),
+                                  meta_path=str(tmp_path / "ingested.jsonl"), max_pending=2)
+
+    async def run():
+        queue = asyncio.Queue(maxsize=watcher.max_pending)
+        task = asyncio.ensure_future(watcher.scan(queue, asyncio.Event()))
+        await asyncio.sleep(0.05)
+        size, flight = queue.qsize(), len(watcher.in_flight)
+        task.cancel()
+        return size, flight
+
+    size, flight = asyncio.run(run())
+    # 대기열 2개 + put 대기 중 1개만 메모리에 있고 나머지는 디스크에 남음
+    assert size == 2 and flight == 3
+
+
+def test_watch_refuses_corrupted_gallery(tmp_path):
+    data = {"cat_001": np.ones((1, 3))}
+    header = make_gallery_header(data)
+    save_gallery(str(tmp_path / "g.npz"), {"cat_001": np.zeros((1, 3))}, header)
+    with pytest.raises(ValueError, match="checksum"):
+        watch.FolderWatcher(str(tmp_path), str(tmp_path / "g.npz"),
+                            meta_path=str(tmp_path / "ingested.jsonl"))
+
+
+def test_watch_keeps_files_with_repeated_names(monkeypatch, tmp_path):
+    _stub_vectors(monkeypatch)
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    gallery_path, meta_path = str(tmp_path / "g.npz"), tmp_path / "ingested.jsonl"
+    # 카메라가 같은 이름을 재사용: 내용이 다른 a_IMG.jpg 두 장이 차례로 도착
+    for color, name in [((255, 0, 0), "a_IMG.jpg"), ((250, 0, 0), "a_IMG.jpg")]:
+        _make_image(inbox / name, color)
+        watch.watch_folder(str(inbox), gallery_path, once=True, meta_path=str(meta_path),
+                           append_matches=True)
+
+    rows = [json.loads(x) for x in meta_path.read_text(encoding="utf-8").splitlines()]
+    assert len(rows) == 2 and rows[0]["image_path"] != rows[1]["image_path"]
+    assert all(os.path.exists(r["image_path"]) for r in rows)
+    assert len(os.listdir(inbox / "processed")) == 2
+
+
+def test_bad_image_in_batch_does_not_fail_the_others(monkeypatch, tmp_path):
+    _stub_vectors(monkeypatch)
+    stub = watch.build_vectors
+
+    def build_or_fail(metas, bounds=None, weights=None):
+        # CLIP 모드에서 잘린 JPEG가 배치 전체의 convert("RGB")를 실패시키는 상황
+        if any(os.path.basename(m.image_path).startswith("a_bad") for m in metas):
+            raise OSError("image file is truncated")
+        return stub(metas, bounds, weights)
+
+    monkeypatch.setattr(watch, "build_vectors", build_or_fail)
+    for name in ("a1.jpg", "a_bad.jpg", "b1.jpg"):
+        _make_image(tmp_path / name, (1, 2, 3))
+    watcher = watch.FolderWatcher(str(tmp_path), str(tmp_path / "g.npz"),
+                                  meta_path=str(tmp_path / "ingested.jsonl"), batch_size=3)
+    asyncio.run(watcher.run(once=True))
+
+    assert sorted(n.split("_", 1)[1] for n in os.listdir(tmp_path / "processed")) == ["a1.jpg", "b1.jpg"]
+    assert [n.split("_", 1)[1] for n in os.listdir(tmp_path / "failed")] == ["a_bad.jpg"]
+    assert watcher.in_flight == set()
+
+
+def test_failing_batch_goes_to_failed_and_worker_continues(tmp_path):
+    for name in ("a1.jpg", "b1.jpg"):
+        _make_image(tmp_path / name, (1, 2, 3))
+    watcher = watch.FolderWatcher(str(tmp_path), str(tmp_path / "g.npz"),
+                                  meta_path=str(tmp_path / "ingested.jsonl"), batch_size=1, window=0)
+    processed = []
+
+    def flaky(paths):
+        if paths[0].name == "a1.jpg":
+            raise RuntimeError("boom")
+        processed.extend(p.name for p in paths)
+        for p in paths:
+            watcher._move(p, watch.DONE_DIR)
+        return []
+
+    watcher.process_batch = flaky
+    asyncio.run(watcher.run(once=True))
+
+    assert processed == ["b1.jpg"]
+    assert [n.split("_", 1)[1] for n in os.listdir(tmp_path / "failed")] == ["a1.jpg"]
+    assert watcher.in_flight == set()
+
+
+def test_ready_files_respects_limit(tmp_path):
+    for i in range(10):
+        _make_image(tmp_path / f"a{i}.jpg", (i, i, i))
+    watcher = watch.FolderWatcher(str(tmp_path), str(tmp_path / "g.npz"),
+                                  meta_path=str(tmp_path / "ingested.jsonl"))
+    assert len(watcher.ready_files(limit=3)) == 3
+
+
+def test_match_batch_equals_sequential_match_query(tmp_path):
+    rng = np.random.default_rng(7)
+    base = {f"cat_{i:03d}": rng.normal(size=(int(rng.integers(1, 3)), 5)) for i in range(1, 4)}
+    new = rng.normal(size=(3, 5))
+    # 갤러리 사진 근처 + 새 개체 + 같은 새 개체의 재등장이 섞인 배치
+    vecs = np.vstack([base["cat_002"][0] + 0.01, new[0], new[0] + 0.01, new[1], new[2], new[1] + 0.02])
+    for append_matches in (False, True):
+        watcher = watch.FolderWatcher(str(tmp_path), str(tmp_path / "none.npz"),
+                                      threshold=0.9, margin=0.0, append_matches=append_matches)
+        watcher.gallery = {k: v.copy() for k, v in base.items()}
+        got = watcher._match_batch(vecs)
+
+        ref_gal, expected = {k: v.copy() for k, v in base.items()}, []
+        for v in vecs:
+            pred, sim = match_query(v, ref_gal, threshold=0.9, margin=0.0)
+            if pred == "UNKNOWN" and sim < 0.9:
+                cat_id = watcher._next_id(list(ref_gal))
+                ref_gal[cat_id] = v[None, :]
+                action = "new"
+            elif pred != "UNKNOWN" and append_matches:
+                cat_id, action = pred, "appended"
+                ref_gal[cat_id] = np.vstack([ref_gal[cat_id], v])
+            else:
+                cat_id, action = pred, "matched" if pred != "UNKNOWN" else "ambiguous"
+            expected.append((pred, cat_id, action))
+        assert [(p, c, a) for p, _, c, a in got] == expected
+        assert {a for _, _, a in expected} >= {"new"}
+
+
+def test_gallery_rewrite_is_rate_limited_and_replayed_from_log(monkeypatch, tmp_path):
+    _stub_vectors(monkeypatch)
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    for name, color in [("a1.jpg", (255, 0, 0)), ("b1.jpg", (0, 0, 255)), ("a2.jpg", (250, 0, 0))]:
+        _make_image(inbox / name, color)
+    gallery_path, meta_path = tmp_path / "g.npz", tmp_path / "ingested.jsonl"
+    kwargs = dict(meta_path=str(meta_path), flush_interval=1e9, append_matches=True)
+
+    watcher = watch.FolderWatcher(str(inbox), str(gallery_path), **kwargs)
+    watcher.process_batch([inbox / "a1.jpg"])
+    watcher.process_batch([inbox / "b1.jpg"])
+    # 간격 안의 배치는 JSONL에만 append, 갤러리 파일은 쓰지 않음
+    assert not gallery_path.exists()
+    assert len(meta_path.read_text(encoding="utf-8").splitlines()) == 2
+    watcher.flush()
+    assert read_gallery_header(str(gallery_path))["rows"] == 2
+
+    watcher.process_batch([inbox / "a2.jpg"])  # cat_001에 추가되지만 갤러리 파일은 그대로
+    assert read_gallery_header(str(gallery_path))["rows"] == 2
+
+    # flush 전에 종료된 것으로 보고 다시 시작 → JSONL에서 a2 복구
+    restarted = watch.FolderWatcher(str(inbox), str(gallery_path), **kwargs)
+    assert read_gallery_header(str(gallery_path))["rows"] == 3
+    assert {k: len(v) for k, v in load_gallery(str(gallery_path)).items()} == {"cat_001": 2, "cat_002": 1}
+    assert not restarted.dirty
+
+
+def test_image_waits_for_sidecar_and_orphans_are_moved(tmp_path):
+    now = time.time()
+    _make_image(tmp_path / "a1.jpg", (1, 2, 3))
+    os.utime(tmp_path / "a1.jpg", (now - 3, now - 3))  # settle은 지났지만 sidecar_wait은 안 지남
+    (tmp_path / "late.json").write_text("{}", encoding="utf-8")  # 이미지가 이미 처리된 뒤 도착
+    os.utime(tmp_path / "late.json", (0, 0))
+    (tmp_path / "early.json").write_text("{}", encoding="utf-8")  # 이미지보다 먼저 도착
+    watcher = watch.FolderWatcher(str(tmp_path), str(tmp_path / "g.npz"),
+                                  meta_path=str(tmp_path / "ingested.jsonl"), settle=1.0,
+                                  sidecar_wait=5.0)
+
+    assert watcher.ready_files(limit=10) == []
+    assert [n.split("_", 1)[1] for n in os.listdir(tmp_path / "failed")] == ["late.json"]
+    assert (tmp_path / "early.json").exists()
+
+    # 사이드카가 도착하면 settle만 기다림
+    (tmp_path / "a1.json").write_text(json.dumps({"coat_type": "tuxedo"}), encoding="utf-8")
+    os.utime(tmp_path / "a1.json", (now - 2, now - 2))
+    assert watcher.ready_files(limit=10) == [tmp_path / "a1.jpg"]